@@ -1,12 +1,21 @@
 # api_server.py
 
+import asyncio
+import logging
+import logging.handlers
 import os
+import queue
 import time
-from typing import List
-import google.generativeai as genai
+from contextlib import asynccontextmanager
+from typing import List, Literal
+import httpx
+import orjson
+from google import genai
+from google.genai import types
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict
 from fastapi.middleware.cors import CORSMiddleware
 
 # Import our custom modules
@@ -17,9 +26,37 @@ import negotiation_engine
 
 # --- Configuration & Initialization ---
 load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # While the app runs, log records are handed to a queue and written to
+    # stderr by a background listener thread, so logging never blocks the
+    # event loop on I/O.
+    log_queue = queue.Queue(-1)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    root_logger = logging.getLogger()
+    root_logger.addHandler(queue_handler)
+    # Only this app's loggers go down to INFO; the root level is left alone so
+    # libraries such as httpx do not log every upstream request.
+    for name in (__name__, negotiation_engine.__name__):
+        logging.getLogger(name).setLevel(logging.INFO)
+    log_listener.start()
+    try:
+        yield
+    finally:
+        root_logger.removeHandler(queue_handler)
+        log_listener.stop()
+
 app = FastAPI(
     title="Dynamic Negotiation API",
     description="An API to simulate a negotiation between two dynamic AI personas.",
+    # The endpoints return plain dicts without response models, so FastAPI's
+    # Pydantic serialization path does not apply; orjson does the encoding.
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 
 # --- ADD THIS MIDDLEWARE BLOCK ---
@@ -47,19 +84,41 @@ try:
     API_KEY_2 = os.getenv("GOOGLE_API_KEY_2", API_KEY_1) # Fallback
     
     if not API_KEY_1:
-        print("Warning: GOOGLE_API_KEY environment variable not found.")
-    else:
-        # Configure with a default key. This will be switched as needed in the engine.
-        genai.configure(api_key=API_KEY_1)
+        logger.warning("GOOGLE_API_KEY environment variable not found.")
 
 except Exception as e:
-    print(f"Error during initial loading: {e}")
+    logger.error(f"Error during initial loading: {e}")
     API_KEY_1 = None
     API_KEY_2 = None
 
+# The 2-5 second "thinking" pause before each turn is pure dead time, so it is
+# opt-in. Set NEGOTIATION_THINK_PAUSE=1 to restore it.
+THINKING_PAUSE = os.getenv("NEGOTIATION_THINK_PAUSE", "").lower() in ("1", "true", "yes")
+
+# Upper bound on negotiations running at once within a single /negotiate/batch call
+BATCH_MAX_CONCURRENT = int(os.getenv("NEGOTIATION_BATCH_CONCURRENCY", "32"))
+# Largest list of negotiations a single /negotiate/batch call accepts
+BATCH_MAX_SIZE = int(os.getenv("NEGOTIATION_BATCH_MAX_SIZE", "100"))
+
+# One client per API key, created once and shared by every request so that
+# pooled HTTP connections are reused instead of reconnecting per negotiation.
+CLIENT_POOL = {
+    api_key: genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(
+            async_client_args={"limits": httpx.Limits(max_connections=200)}
+        ),
+    )
+    for api_key in {API_KEY_1, API_KEY_2}
+    if api_key
+}
+
 
 # --- Pydantic Models for API Request Body ---
+# Both models are frozen: validated request data is never modified afterwards
 class CharacterProfile(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
     name: str
     profession: str
     background: str
@@ -70,96 +129,229 @@ class CharacterProfile(BaseModel):
     model_name: str = "gemini-1.5-flash"
 
 class NegotiationRequest(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
     topic: str
     duration_seconds: int = 60
     character1: CharacterProfile
     character2: CharacterProfile
+    # "parallel" lets both parties answer at once each round instead of alternating
+    mode: Literal["strict", "parallel"] = "strict"
 
 # --- Helper Functions ---
-async def get_negotiation_summary(transcript: list, topic: str) -> str:
-    if not transcript:
+# The prompt is ordered static instructions -> transcript -> topic-specific
+# questions so that nothing request-specific comes before the transcript.
+# The static part alone is far below Gemini's minimum cacheable size, so this
+# ordering does not by itself produce prompt-cache hits.
+SUMMARY_TEMPLATE = """
+You are a neutral analyst. Read the negotiation transcript below and provide a brief, neutral summary of the outcome.
+Transcript:
+---
+{log}
+---
+The negotiation was about '{topic}'. Answer these questions:
+1. What was the final position of each party?
+2. Was a clear agreement reached? If so, what were the terms?
+3. If no agreement was reached, what were the main points of contention?
+"""
+
+# Same ordering for the per-excerpt prompts used on long transcripts
+PARTIAL_SUMMARY_TEMPLATE = """
+You are a neutral analyst. Condense this excerpt of a negotiation transcript, keeping each party's positions, offers and concessions.
+Excerpt:
+---
+{log}
+---
+The negotiation was about '{topic}'.
+"""
+
+# Transcripts estimated above this many tokens (~4 characters each) are
+# condensed in excerpts first, level by level, until a single excerpt is left,
+# so a long debate cannot grow the summary prompt unbounded.
+SUMMARY_MAX_TOKENS = 3000
+
+# Upper bound on excerpt-condensing calls in flight for one summary
+SUMMARY_MAX_CONCURRENT = int(os.getenv("NEGOTIATION_SUMMARY_CONCURRENCY", "4"))
+
+def chunk_lines(lines: list, max_tokens: int) -> list:
+    """Groups log lines into excerpts of roughly max_tokens each."""
+    chunks, excerpt, size = [], [], 0
+    for line in lines:
+        tokens = len(line) // 4
+        if excerpt and size + tokens > max_tokens:
+            chunks.append("\n".join(excerpt))
+            excerpt, size = [], 0
+        excerpt.append(line)
+        size += tokens
+    if excerpt:
+        chunks.append("\n".join(excerpt))
+    return chunks
+
+def chunk_transcript(speakers: list, messages: list, max_tokens: int) -> list:
+    """Splits a transcript into log excerpts of roughly max_tokens each."""
+    return chunk_lines((f"{speaker}: {message}" for speaker, message in zip(speakers, messages)), max_tokens)
+
+async def get_negotiation_summary(transcript: dict, topic: str) -> str:
+    if not transcript["message"]:
         return "The negotiation did not start or an error occurred."
     if not API_KEY_1:
         return "Summarization failed: API key not configured."
     try:
-        # Ensure the summarizer uses the primary API key
-        genai.configure(api_key=API_KEY_1)
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        
-        conversation_log = "\n".join([f"{item['speaker']}: {item['message']}" for item in transcript if 'error' not in item])
-        
-        prompt = f"""
-        Based on the following negotiation transcript about '{topic}', please provide a brief, neutral summary of the outcome.
-        Answer these questions:
-        1. What was the final position of each party?
-        2. Was a clear agreement reached? If so, what were the terms?
-        3. If no agreement was reached, what were the main points of contention?
-        Transcript:
-        ---
-        {conversation_log}
-        ---
-        """
-        response = await model.generate_content_async(prompt)
-        return response.text
+        # The summarizer always runs on the primary API key
+        client = CLIENT_POOL[API_KEY_1]
+        semaphore = asyncio.Semaphore(SUMMARY_MAX_CONCURRENT)
+
+        async def summarize(prompt: str) -> str:
+            async with semaphore:
+                response = await negotiation_engine.with_retry(
+                    lambda: client.aio.models.generate_content(model='gemini-2.5-flash', contents=prompt)
+                )
+            return response.text or ""
+
+        chunks = chunk_transcript(transcript["speaker"], transcript["message"], SUMMARY_MAX_TOKENS)
+        while len(chunks) > 1:
+            # Map-reduce: condense the excerpts, then regroup the condensed parts
+            partials = await asyncio.gather(
+                *(summarize(PARTIAL_SUMMARY_TEMPLATE.format(topic=topic, log=chunk)) for chunk in chunks)
+            )
+            parts = [f"[Part {i} of {len(partials)}]\n{partial}" for i, partial in enumerate(partials, 1)]
+            regrouped = chunk_lines(parts, SUMMARY_MAX_TOKENS)
+            if len(regrouped) >= len(chunks):
+                # Condensing did not shrink the log; pair the parts so the loop still ends
+                regrouped = ["\n\n".join(parts[i:i + 2]) for i in range(0, len(parts), 2)]
+            chunks = regrouped
+        return await summarize(SUMMARY_TEMPLATE.format(topic=topic, log=chunks[0]))
     except Exception as e:
         return f"Could not generate summary: {e}"
 
-# --- API Endpoint ---
-@app.post("/negotiate")
-async def start_negotiation_endpoint(request: NegotiationRequest):
+def persona_instruction(profile: dict) -> str:
+    """Builds the system instruction from a dumped profile."""
+    return persona_factory.create_system_instruction(
+        **{k: v for k, v in profile.items() if k != 'model_name'}
+    )
+
+def prepare_negotiation(request: NegotiationRequest, profile1: dict, profile2: dict) -> dict:
+    """
+    Builds the chat sessions and prompts, returned as run_negotiation kwargs.
+    profile1 and profile2 are the characters' dumps, made once per request.
+    """
     if not API_KEY_1 or not API_KEY_2:
         raise HTTPException(status_code=500, detail="Google API keys are not configured on the server.")
-    
-    start_time = time.time()
-    
-    instruction1 = persona_factory.create_system_instruction(**request.character1.model_dump(exclude={'model_name'}))
-    instruction2 = persona_factory.create_system_instruction(**request.character2.model_dump(exclude={'model_name'}))
+
+    instruction1 = persona_instruction(profile1)
+    instruction2 = persona_instruction(profile2)
     
     try:
-        model1 = genai.GenerativeModel(
-            model_name=request.character1.model_name,
-            system_instruction=instruction1
+        # Each chat runs on the pooled client for its own API key
+        chat1 = CLIENT_POOL[API_KEY_1].aio.chats.create(
+            model=request.character1.model_name,
+            config=types.GenerateContentConfig(system_instruction=instruction1)
         )
-        model2 = genai.GenerativeModel(
-            model_name=request.character2.model_name,
-            system_instruction=instruction2
+        chat2 = CLIENT_POOL[API_KEY_2].aio.chats.create(
+            model=request.character2.model_name,
+            config=types.GenerateContentConfig(system_instruction=instruction2)
         )
-        
-        chat1 = model1.start_chat(history=[])
-        chat2 = model2.start_chat(history=[])
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to initialize AI models: {e}")
     
-    initial_prompt = f"""
+    initial_prompt_1 = f"""
     As {request.character1.name}, make your opening statement to {request.character2.name}
     regarding the negotiation on '{request.topic}'. Clearly state your initial position
     based on your objective: '{request.character1.objective}'.
     """
+    initial_prompt_2 = f"""
+    As {request.character2.name}, make your opening statement to {request.character1.name}
+    regarding the negotiation on '{request.topic}'. Clearly state your initial position
+    based on your objective: '{request.character2.objective}'.
+    """
     
-    transcript = negotiation_engine.run_negotiation(
+    return dict(
         model1_session=chat1,
         model2_session=chat2,
         model1_name=f"{request.character1.name} ({request.character1.background})",
         model2_name=f"{request.character2.name} ({request.character2.background})",
-        initial_prompt=initial_prompt,
+        initial_prompt_1=initial_prompt_1,
+        initial_prompt_2=initial_prompt_2,
         duration_seconds=request.duration_seconds,
-        api_key_1=API_KEY_1,
-        api_key_2=API_KEY_2
+        thinking_pause=THINKING_PAUSE,
+        mode=request.mode
     )
+
+# --- API Endpoints ---
+async def negotiate(request: NegotiationRequest) -> dict:
+    """Runs one negotiation end to end and returns the response body."""
+    start_time = time.time()
+    profile1 = request.character1.model_dump(mode="json")
+    profile2 = request.character2.model_dump(mode="json")
+    negotiation = prepare_negotiation(request, profile1, profile2)
+    
+    transcript = await negotiation_engine.run_negotiation(**negotiation)
     
     summary = await get_negotiation_summary(transcript, request.topic)
     end_time = time.time()
     
-    final_response = {
+    return {
         "negotiation_summary": {
             "topic": request.topic,
             "duration_seconds": round(end_time - start_time),
             "outcome_analysis": summary,
         },
         "participants": [
-            request.character1.model_dump(),
-            request.character2.model_dump()
+            profile1,
+            profile2
         ],
-        "transcript": transcript
+        "transcript": negotiation_engine.transcript_rows(transcript)
     }
-    return final_response
+
+@app.post("/negotiate")
+async def start_negotiation_endpoint(request: NegotiationRequest):
+    return await negotiate(request)
+
+@app.post("/negotiate/batch")
+async def batch_negotiation_endpoint(requests: List[NegotiationRequest]):
+    """
+    Runs many negotiations concurrently, at most BATCH_MAX_CONCURRENT at a time,
+    and returns their responses in input order. A negotiation that fails is
+    reported as {"error": ...} in its slot without affecting the others.
+    """
+    if len(requests) > BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=422,
+            detail=f"A batch may contain at most {BATCH_MAX_SIZE} negotiations."
+        )
+    semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENT)
+
+    async def run_one(request: NegotiationRequest) -> dict:
+        async with semaphore:
+            try:
+                return await negotiate(request)
+            except HTTPException as e:
+                return {"error": e.detail}
+            except Exception as e:
+                logger.error(f"Batch negotiation failed: {e}")
+                return {"error": str(e)}
+
+    return await asyncio.gather(*(run_one(request) for request in requests))
+
+@app.post("/negotiate/stream")
+async def stream_negotiation_endpoint(request: NegotiationRequest):
+    """
+    Streams the negotiation as NDJSON: one {"turn", "speaker", "delta"} row per
+    generated chunk, followed by a final {"summary"} row.
+    """
+    negotiation = prepare_negotiation(
+        request,
+        request.character1.model_dump(mode="json"),
+        request.character2.model_dump(mode="json")
+    )
+
+    async def ndjson_rows():
+        # Complete turns are still collected because the summarizer needs them
+        transcript = negotiation_engine.new_transcript()
+        async for row in negotiation_engine.stream_negotiation(**negotiation):
+            negotiation_engine.add_to_transcript(transcript, row)
+            yield orjson.dumps(row) + b"\n"
+        summary = await get_negotiation_summary(transcript, request.topic)
+        yield orjson.dumps({"summary": summary}) + b"\n"
+
+    return StreamingResponse(ndjson_rows(), media_type="application/x-ndjson")
@@ -1,94 +1,302 @@
 # negotiation_engine.py
 
+import asyncio
+import logging
 import time
 import random
-import google.generativeai as genai
 
-def simulate_thinking_pause(diplomat_name: str):
+from google.genai import errors as genai_errors
+
+logger = logging.getLogger(__name__)
+
+# NOTE: API keys are bound to a genai.Client when it is created. Chat sessions
+# must come from the pooled client for their key; never swap keys through
+# process-wide state at request time, since negotiations run concurrently.
+
+async def simulate_thinking_pause(diplomat_name: str):
     """Creates a variable, realistic pause to simulate thinking."""
     pause_duration = random.uniform(2, 5) # Shortened for faster API responses
-    print(f"[{diplomat_name} is considering a response...]")
-    time.sleep(pause_duration)
+    logger.debug(f"[{diplomat_name} is considering a response...]")
+    await asyncio.sleep(pause_duration)
+
+
+# Upstream status codes that are worth retrying: rate limiting and overload
+RETRYABLE_STATUS_CODES = (429, 503)
+
+
+def is_retryable(error: Exception) -> bool:
+    """Whether an error is a rate-limit or overload response worth retrying."""
+    return isinstance(error, genai_errors.APIError) and error.code in RETRYABLE_STATUS_CODES
+
+
+def retry_after(error: Exception):
+    """Returns the retry delay in seconds the server asked for, if any."""
+    details = getattr(error, "details", None)
+    body = details.get("error", details) if isinstance(details, dict) else None
+    items = body.get("details") if isinstance(body, dict) else None
+    if not isinstance(items, list):
+        return None
+    for item in items:
+        delay = item.get("retryDelay") if isinstance(item, dict) else None
+        if isinstance(delay, str) and delay:
+            try:
+                return float(delay.rstrip("s"))
+            except ValueError:
+                return None
+    return None
+
+
+# Longest single wait between retries, whatever the server asks for
+MAX_RETRY_DELAY = 30
+
+
+class RetryDeadlineExceeded(Exception):
+    """Raised when a call is still rate limited and waiting to retry would pass the deadline."""
+
+
+async def with_retry(coro_fn, attempts: int = 4, deadline: float = None):
+    """
+    Awaits coro_fn(), retrying rate-limit and overload errors with full-jitter
+    exponential backoff (or the server's requested delay), capped at
+    MAX_RETRY_DELAY. Re-raises the last error, or raises RetryDeadlineExceeded
+    if waiting to retry would pass the deadline (a time.time() value).
+    """
+    for attempt in range(attempts):
+        try:
+            return await coro_fn()
+        except genai_errors.APIError as e:
+            if not is_retryable(e) or attempt == attempts - 1:
+                raise
+            delay = min(retry_after(e) or 2 ** attempt + random.random(), MAX_RETRY_DELAY)
+            if deadline is not None and time.time() + delay >= deadline:
+                raise RetryDeadlineExceeded(f"{e} (no time left to retry)") from e
+            logger.warning(f"Gemini call failed ({e}); retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def take_turn(
+    session,
+    diplomat_name: str,
+    message: str,
+    thinking_pause: bool = False,
+    deadline: float = None
+) -> str:
+    """Optionally pauses for the speaker, sends the message and returns the reply text."""
+    if thinking_pause:
+        await simulate_thinking_pause(diplomat_name)
+    response = await with_retry(lambda: session.send_message(message), deadline=deadline)
+    # google-genai reports a blocked or empty reply as text=None
+    return response.text or ""
+
+
+async def stream_turn(
+    session,
+    diplomat_name: str,
+    message: str,
+    thinking_pause: bool = False,
+    deadline: float = None
+):
+    """Optionally pauses for the speaker, then yields the reply text as it is generated."""
+    if thinking_pause:
+        await simulate_thinking_pause(diplomat_name)
 
+    # The request is only made once the stream is iterated, so the retry
+    # covers everything up to the first chunk.
+    async def open_stream():
+        stream = await session.send_message_stream(message)
+        return stream, await anext(stream, None)
 
-def run_negotiation(
+    stream, chunk = await with_retry(open_stream, deadline=deadline)
+    while chunk is not None:
+        yield chunk.text or ""
+        chunk = await anext(stream, None)
+
+
+async def stream_negotiation(
     model1_session,
     model2_session,
     model1_name: str,
     model2_name: str,
-    initial_prompt: str,
+    initial_prompt_1: str,
+    initial_prompt_2: str,
     duration_seconds: int,
-    api_key_1: str,
-    api_key_2: str
-) -> list:
+    thinking_pause: bool = False,
+    mode: str = "strict"
+):
     """
-    Orchestrates the negotiation and returns a structured transcript.
-    This now switches the global API key before each call.
+    Orchestrates the negotiation, yielding each reply as it is generated.
+    Rows look like {"turn", "speaker", "delta"}, with {"error"} rows for failures.
+    A turn that is still rate limited after retries is recorded as an error and
+    attempted again, unless there is no time left to retry; any other failure
+    ends the stream.
+    The artificial thinking pause before each turn is off unless thinking_pause is set.
+    In "strict" mode Model 1 opens and the parties alternate, streaming each reply.
+    In "parallel" mode both open and then answer at once every round, and each
+    reply arrives as a single row; only this mode uses initial_prompt_2.
     """
-    print("--- Starting Negotiation Engine ---")
+    logger.info("--- Starting Negotiation Engine ---")
     negotiation_start_time = time.time()
-    transcript = []
+    # Retries stop once they would run past the negotiation's time budget
+    deadline = negotiation_start_time + duration_seconds
     turn_counter = 0
+    # Turn text is logged once at the end rather than after every turn, and
+    # only collected when debug logging is on
+    log_turns = logger.isEnabledFor(logging.DEBUG)
+    turn_log = []
 
     try:
-        # --- Turn 0 (Opening Statement from Model 1) ---
-        simulate_thinking_pause(model1_name)
-        # Set the global API key for Model 1
-        genai.configure(api_key=api_key_1)
-        response_text = model1_session.send_message(initial_prompt).text
-        current_message = response_text
-        
-        turn_data = {
-            "turn": turn_counter,
-            "speaker": model1_name,
-            "message": response_text
-        }
-        transcript.append(turn_data)
-        print(f"{model1_name}: {response_text}\n")
-        turn_counter += 1
-
-        # --- Main Negotiation Loop ---
-        while time.time() - negotiation_start_time < duration_seconds:
-            # --- Model 2's Turn ---
-            simulate_thinking_pause(model2_name)
-            # Set the global API key for Model 2
-            genai.configure(api_key=api_key_2)
-            response_text = model2_session.send_message(current_message).text
-            current_message = response_text
-            
-            turn_data = {
-                "turn": turn_counter,
-                "speaker": model2_name,
-                "message": response_text
-            }
-            transcript.append(turn_data)
-            print(f"{model2_name}: {response_text}\n")
-            
-            if time.time() - negotiation_start_time >= duration_seconds:
-                break
-
-            # --- Model 1's Turn ---
-            simulate_thinking_pause(model1_name)
-            # Set the global API key for Model 1 again
-            genai.configure(api_key=api_key_1)
-            response_text = model1_session.send_message(current_message).text
-            current_message = response_text
-
-            turn_data = {
-                "turn": turn_counter + 1,
-                "speaker": model1_name,
-                "message": response_text
-            }
-            transcript.append(turn_data)
-            print(f"{model1_name}: {response_text}\n")
-            
-            turn_counter += 2
+        if mode == "parallel":
+            # Each round every party with an unanswered message replies, all at
+            # the same time; the replies become the next round's messages. The
+            # first round is both opening statements, and it always runs.
+            sessions = ((model1_session, model1_name), (model2_session, model2_name))
+            pending = [initial_prompt_1, initial_prompt_2]
+            openings_attempted = False
+
+            # --- Parallel Negotiation Loop ---
+            while not openings_attempted or time.time() - negotiation_start_time < duration_seconds:
+                openings_attempted = True
+                active = [i for i in (0, 1) if pending[i] is not None]
+                results = await asyncio.gather(
+                    *(take_turn(*sessions[i], pending[i], thinking_pause, deadline) for i in active),
+                    return_exceptions=True
+                )
+                next_pending = list(pending)
+                replies = {}
+                fatal_error = None
+                for i, result in zip(active, results):
+                    if isinstance(result, Exception):
+                        if not is_retryable(result):
+                            # Record the other party's reply before giving up
+                            fatal_error = result
+                            continue
+                        # The failed party answers its unchanged message next round
+                        logger.error(f"Turn {turn_counter} failed after retries: {result}")
+                        yield {"error": str(result)}
+                        continue
+                    speaker = sessions[i][1]
+                    yield {"turn": turn_counter, "speaker": speaker, "delta": result}
+                    if log_turns:
+                        turn_log.append(f"{speaker}: {result}")
+                    turn_counter += 1
+                    replies[i] = result
+                    next_pending[i] = None
+                if fatal_error is not None:
+                    raise fatal_error
+                for i, reply in replies.items():
+                    # A counterpart that has not answered its previous message
+                    # yet gets the new reply appended to it.
+                    other = 1 - i
+                    if next_pending[other] is not None:
+                        next_pending[other] = f"{next_pending[other]}\n\n{reply}"
+                    else:
+                        next_pending[other] = reply
+                pending = next_pending
+        else:
+            # Turn 0 is Model 1's opening statement; from then on each party
+            # answers the other's previous message. Only Model 1 gets an
+            # opening prompt, and the opening is always attempted once.
+            current_message = initial_prompt_1
+            speakers = ((model1_session, model1_name), (model2_session, model2_name))
+            opening_attempted = False
+
+            # --- Main Negotiation Loop ---
+            while not opening_attempted or time.time() - negotiation_start_time < duration_seconds:
+                opening_attempted = True
+                session, speaker = speakers[turn_counter % 2]
+                parts = []
+                try:
+                    async for delta in stream_turn(session, speaker, current_message, thinking_pause, deadline):
+                        parts.append(delta)
+                        yield {"turn": turn_counter, "speaker": speaker, "delta": delta}
+                except genai_errors.APIError as e:
+                    # Keep what has been negotiated so far; a turn that already
+                    # streamed text cannot be replayed, so only retry empty ones.
+                    if parts or not is_retryable(e):
+                        raise
+                    logger.error(f"Turn {turn_counter} failed after retries: {e}")
+                    yield {"error": str(e)}
+                    continue
+                current_message = "".join(parts)
+                if log_turns:
+                    turn_log.append(f"{speaker}: {current_message}")
+                turn_counter += 1
 
     except Exception as e:
-        print(f"An error occurred during negotiation: {e}")
-        # Append error to transcript if needed
-        transcript.append({"error": str(e)})
+        logger.error(f"An error occurred during negotiation: {e}")
+        yield {"error": str(e)}
 
     finally:
-        print("--- Negotiation Engine Finished ---")
-        return transcript
+        if turn_log:
+            logger.debug("\n\n".join(turn_log))
+        logger.info("--- Negotiation Engine Finished ---")
+
+
+def new_transcript() -> dict:
+    """
+    Returns an empty columnar transcript: parallel turn/speaker/message lists,
+    plus the errors raised along the way and, in error_at, how many turns had
+    been recorded when each one happened.
+    """
+    return {"turn": [], "speaker": [], "message": [], "error": [], "error_at": []}
+
+
+def add_to_transcript(transcript: dict, row: dict):
+    """Folds a streamed row into a columnar transcript of complete turns."""
+    if "error" in row:
+        transcript["error"].append(row["error"])
+        transcript["error_at"].append(len(transcript["turn"]))
+    elif transcript["turn"] and transcript["turn"][-1] == row["turn"]:
+        transcript["message"][-1] += row["delta"]
+    else:
+        transcript["turn"].append(row["turn"])
+        transcript["speaker"].append(row["speaker"])
+        transcript["message"].append(row["delta"])
+
+
+def transcript_rows(transcript: dict) -> list:
+    """Materializes a columnar transcript as the list of turn dicts the API returns."""
+    errors = zip(transcript["error_at"], transcript["error"])
+    position, error = next(errors, (None, None))
+    rows = []
+    # Merge in one pass: each error goes before the turn at its recorded position
+    for index, row in enumerate(zip(transcript["turn"], transcript["speaker"], transcript["message"])):
+        while position == index:
+            rows.append({"error": error})
+            position, error = next(errors, (None, None))
+        rows.append(dict(zip(("turn", "speaker", "message"), row)))
+    # Errors recorded after the last turn
+    while position is not None:
+        rows.append({"error": error})
+        position, error = next(errors, (None, None))
+    return rows
+
+
+async def run_negotiation(
+    model1_session,
+    model2_session,
+    model1_name: str,
+    model2_name: str,
+    initial_prompt_1: str,
+    initial_prompt_2: str,
+    duration_seconds: int,
+    thinking_pause: bool = False,
+    mode: str = "strict"
+) -> dict:
+    """
+    Runs the negotiation to completion and returns a columnar transcript.
+    """
+    transcript = new_transcript()
+    async for row in stream_negotiation(
+        model1_session,
+        model2_session,
+        model1_name,
+        model2_name,
+        initial_prompt_1,
+        initial_prompt_2,
+        duration_seconds,
+        thinking_pause,
+        mode
+    ):
+        add_to_transcript(transcript, row)
+    return transcript
@@ -1,5 +1,8 @@
 # persona_factory.py
 
+import functools
+
+@functools.lru_cache(maxsize=1024)
 def create_system_instruction(
     name: str,
     profession: str,
@@ -11,6 +14,8 @@ def create_system_instruction(
 ) -> str:
     """
     Dynamically generates a system instruction prompt for a generative AI model.
+    Results are cached per argument set, so a persona's instruction is treated as
+    immutable; a changed persona is simply a new set of arguments.
     """
     return f"""
     You are {name} ({background}), a {profession}.
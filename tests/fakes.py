@@ -0,0 +1,87 @@
+# tests/fakes.py
+
+"""In-memory stand-ins for the google-genai async client used by the tests."""
+
+import asyncio
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeChat:
+    """Stands in for a google-genai AsyncChat, recording every message it is sent."""
+
+    def __init__(self, name, replies=None):
+        self.name = name
+        self.received = []
+        # Optional scripted replies; an Exception instance is raised instead
+        self.replies = list(replies or [])
+
+    def reply(self):
+        if self.replies:
+            reply = self.replies.pop(0)
+            if isinstance(reply, Exception):
+                raise reply
+            return reply
+        return f"{self.name}{len(self.received)}"
+
+    async def send_message(self, message):
+        if not isinstance(message, str):
+            raise ValueError(f"Message must be a valid part type, got {type(message)}")
+        self.received.append(message)
+        return FakeResponse(self.reply())
+
+    async def send_message_stream(self, message):
+        self.received.append(message)
+        text = self.reply()
+
+        async def chunks():
+            for part in (text[:1], text[1:]):
+                yield FakeResponse(part)
+
+        return chunks()
+
+
+class FakeChats:
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, model, config):
+        if model == "broken-model":
+            raise ValueError("unknown model")
+        chat = FakeChat(f"{self.client.api_key}:")
+        self.client.chats.append(chat)
+        return chat
+
+
+class FakeModels:
+    def __init__(self, client):
+        self.client = client
+
+    async def generate_content(self, model, contents):
+        self.client.prompts.append(contents)
+        self.client.in_flight += 1
+        self.client.max_in_flight = max(self.client.max_in_flight, self.client.in_flight)
+        await asyncio.sleep(0.001)
+        self.client.in_flight -= 1
+        return FakeResponse(f"summary {len(self.client.prompts)}")
+
+
+class FakeAio:
+    def __init__(self, client):
+        self.chats = FakeChats(client)
+        self.models = FakeModels(client)
+
+
+class FakeClient:
+    """Stands in for genai.Client, bound to one API key like the real one."""
+
+    def __init__(self, api_key):
+        self.api_key = api_key
+        self.chats = []
+        self.prompts = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.aio = FakeAio(self)
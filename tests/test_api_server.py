@@ -0,0 +1,172 @@
+# tests/test_api_server.py
+
+import asyncio
+import logging
+
+import httpx
+import orjson
+import pytest
+from fastapi.testclient import TestClient
+from google import genai
+from google.genai import errors as genai_errors
+
+import api_server
+import persona_factory
+from fakes import FakeClient
+
+
+def character(name, model_name="gemini-1.5-flash"):
+    return {
+        "name": name,
+        "profession": "Diplomat",
+        "background": f"{name} Republic",
+        "mood": "calm",
+        "behavior": "patient",
+        "objective": f"a deal that favours {name}",
+        "strengths": "preparation",
+        "model_name": model_name,
+    }
+
+
+def negotiation(topic="water rights", model_name="gemini-1.5-flash"):
+    return {
+        "topic": topic,
+        "duration_seconds": 0,
+        "character1": character("Ada", model_name),
+        "character2": character("Bo", model_name),
+    }
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    pool = {"key-1": FakeClient("key-1"), "key-2": FakeClient("key-2")}
+    monkeypatch.setattr(api_server, "API_KEY_1", "key-1")
+    monkeypatch.setattr(api_server, "API_KEY_2", "key-2")
+    monkeypatch.setattr(api_server, "CLIENT_POOL", pool)
+    with TestClient(api_server.app) as client:
+        yield client, pool
+
+
+def test_negotiate_returns_transcript_summary_and_participants(clients):
+    client, pool = clients
+    response = client.post("/negotiate", json=negotiation())
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["transcript"] == [{"turn": 0, "speaker": "Ada (Ada Republic)", "message": "key-1:1"}]
+    assert body["negotiation_summary"]["outcome_analysis"] == "summary 1"
+    assert body["participants"] == [character("Ada"), character("Bo")]
+
+
+def test_stream_sends_deltas_errors_and_the_summary_as_ndjson(clients, monkeypatch):
+    client, pool = clients
+    create = pool["key-2"].aio.chats.create
+
+    def create_failing(model, config):
+        chat = create(model, config)
+        chat.replies = [genai_errors.APIError(400, {"error": {"message": "bad request"}})]
+        return chat
+
+    monkeypatch.setattr(pool["key-2"].aio.chats, "create", create_failing)
+    response = client.post("/negotiate/stream", json={**negotiation(), "duration_seconds": 60})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    rows = [orjson.loads(line) for line in response.text.splitlines()]
+    deltas = [row for row in rows if row.get("turn") == 0]
+    assert len(deltas) > 1
+    assert {row["speaker"] for row in deltas} == {"Ada (Ada Republic)"}
+    assert "".join(row["delta"] for row in deltas) == "key-1:1"
+    assert "bad request" in rows[-2]["error"]
+    assert rows[-1] == {"summary": "summary 1"}
+
+
+def test_batch_reports_failures_per_item(clients):
+    client, _ = clients
+    response = client.post("/negotiate/batch", json=[
+        negotiation("first"),
+        negotiation("broken", model_name="broken-model"),
+        negotiation("third"),
+    ])
+
+    assert response.status_code == 200
+    first, broken, third = response.json()
+    assert first["negotiation_summary"]["topic"] == "first"
+    assert "unknown model" in broken["error"]
+    assert third["negotiation_summary"]["topic"] == "third"
+
+
+def test_batch_rejects_oversized_lists(clients, monkeypatch):
+    client, _ = clients
+    monkeypatch.setattr(api_server, "BATCH_MAX_SIZE", 2)
+    response = client.post("/negotiate/batch", json=[negotiation()] * 3)
+
+    assert response.status_code == 422
+
+
+def test_concurrent_negotiations_keep_keys_apart_and_genai_untouched(clients, monkeypatch):
+    _, pool = clients
+
+    def client_per_request(*args, **kwargs):
+        raise AssertionError("genai.Client must not be created at request time")
+
+    monkeypatch.setattr(genai, "Client", client_per_request)
+    genai_state = dict(vars(genai))
+
+    async def negotiate_twice():
+        transport = httpx.ASGITransport(app=api_server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            # Parallel mode opens with both parties, so each key is exercised
+            payloads = [dict(negotiation(topic), mode="parallel") for topic in ("first", "second")]
+            return await asyncio.gather(*(client.post("/negotiate", json=p) for p in payloads))
+
+    responses = asyncio.run(negotiate_twice())
+
+    for response in responses:
+        assert response.status_code == 200
+        assert len(response.json()["transcript"]) == 2
+        for row in response.json()["transcript"]:
+            expected_key = "key-1:" if row["speaker"].startswith("Ada") else "key-2:"
+            assert row["message"].startswith(expected_key)
+    assert dict(vars(genai)) == genai_state
+    assert len(pool["key-1"].chats) == len(pool["key-2"].chats) == 2
+
+
+def test_long_transcripts_are_condensed_until_one_excerpt_remains(clients, monkeypatch):
+    _, pool = clients
+    monkeypatch.setattr(api_server, "SUMMARY_MAX_TOKENS", 20)
+    monkeypatch.setattr(api_server, "SUMMARY_MAX_CONCURRENT", 2)
+    transcript = {
+        "speaker": ["Ada", "Bo"] * 8,
+        "message": ["x" * 60] * 16,
+    }
+
+    summary = asyncio.run(api_server.get_negotiation_summary(transcript, "water rights"))
+
+    prompts = pool["key-1"].prompts
+    assert summary == f"summary {len(prompts)}"
+    assert pool["key-1"].max_in_flight <= 2
+    # Every prompt, including the final one, stays within the excerpt budget
+    template_tokens = len(api_server.SUMMARY_TEMPLATE) // 4
+    assert all(len(prompt) // 4 <= 20 + template_tokens + 20 for prompt in prompts)
+    assert prompts[-1].startswith(api_server.SUMMARY_TEMPLATE.split("{log}")[0])
+
+
+def test_repeated_personas_reuse_the_cached_instruction(clients):
+    client, _ = clients
+    persona_factory.create_system_instruction.cache_clear()
+
+    for _ in range(2):
+        assert client.post("/negotiate", json=negotiation()).status_code == 200
+
+    info = persona_factory.create_system_instruction.cache_info()
+    assert (info.misses, info.hits) == (2, 2)
+
+
+def test_lifespan_only_raises_the_app_log_level():
+    root_level = logging.getLogger().level
+    with TestClient(api_server.app):
+        assert logging.getLogger("api_server").level == logging.INFO
+        assert logging.getLogger("negotiation_engine").level == logging.INFO
+        # Library loggers such as httpx stay at the root level
+        assert logging.getLogger().level == root_level
@@ -0,0 +1,242 @@
+# tests/test_negotiation_engine.py
+
+import asyncio
+import time
+
+import pytest
+from google.genai import errors as genai_errors
+
+import negotiation_engine
+from fakes import FakeChat
+
+
+def run(chat1, chat2, duration_seconds=0, mode="strict"):
+    return asyncio.run(negotiation_engine.run_negotiation(
+        model1_session=chat1,
+        model2_session=chat2,
+        model1_name="A",
+        model2_name="B",
+        initial_prompt_1="p1",
+        initial_prompt_2="p2",
+        duration_seconds=duration_seconds,
+        mode=mode
+    ))
+
+
+def test_strict_mode_has_a_single_opening_and_alternates():
+    chat1, chat2 = FakeChat("A"), FakeChat("B")
+    transcript = run(chat1, chat2, duration_seconds=0.05)
+
+    assert transcript["turn"] == list(range(len(transcript["turn"])))
+    assert transcript["speaker"][:4] == ["A", "B", "A", "B"]
+    assert transcript["message"][:2] == ["A1", "B1"]
+    # Each party only ever hears the other's previous reply
+    assert chat1.received[:2] == ["p1", "B1"]
+    assert chat2.received[0] == "A1"
+    assert "p2" not in chat2.received
+
+
+def test_strict_mode_always_makes_the_opening_statement():
+    chat1, chat2 = FakeChat("A"), FakeChat("B")
+    transcript = run(chat1, chat2, duration_seconds=0)
+
+    assert transcript["message"] == ["A1"]
+    assert chat2.received == []
+
+
+def test_parallel_mode_delivers_both_openings():
+    chat1, chat2 = FakeChat("A"), FakeChat("B")
+    transcript = run(chat1, chat2, duration_seconds=0.05, mode="parallel")
+
+    assert transcript["speaker"][:4] == ["A", "B", "A", "B"]
+    assert chat1.received[:2] == ["p1", "B1"]
+    assert chat2.received[:2] == ["p2", "A1"]
+
+
+def test_transcript_rows_keep_errors_in_place():
+    transcript = negotiation_engine.new_transcript()
+    for row in (
+        {"error": "overloaded"},
+        {"turn": 0, "speaker": "A", "delta": "hel"},
+        {"turn": 0, "speaker": "A", "delta": "lo"},
+        {"error": "rate limited"},
+        {"turn": 1, "speaker": "B", "delta": "hi"},
+        {"error": "aborted"},
+        {"error": "stopped"},
+    ):
+        negotiation_engine.add_to_transcript(transcript, row)
+
+    assert transcript["message"] == ["hello", "hi"]
+    assert negotiation_engine.transcript_rows(transcript) == [
+        {"error": "overloaded"},
+        {"turn": 0, "speaker": "A", "message": "hello"},
+        {"error": "rate limited"},
+        {"turn": 1, "speaker": "B", "message": "hi"},
+        {"error": "aborted"},
+        {"error": "stopped"},
+    ]
+
+
+def rate_limited(retry_delay=None):
+    body = {"error": {"code": 429, "message": "quota", "status": "RESOURCE_EXHAUSTED"}}
+    if retry_delay:
+        body["error"]["details"] = [{"retryDelay": retry_delay}]
+    return genai_errors.APIError(429, body)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(negotiation_engine.asyncio, "sleep", fake_sleep)
+    return delays
+
+
+@pytest.mark.parametrize("details", [
+    {"error": "x"},
+    {"error": {"details": "x"}},
+    {"error": {"details": [{"retryDelay": 5}]}},
+    {"error": {"details": [{"retryDelay": "soon"}]}},
+    ["not", "a", "dict"],
+])
+def test_retry_after_ignores_malformed_bodies(details):
+    error = rate_limited()
+    error.details = details
+    assert negotiation_engine.retry_after(error) is None
+
+
+def test_retry_after_reads_retry_info():
+    assert negotiation_engine.retry_after(rate_limited("37s")) == 37.0
+
+
+def test_with_retry_caps_the_server_delay(sleeps):
+    outcomes = [rate_limited("90s"), "ok"]
+
+    async def call():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    assert asyncio.run(negotiation_engine.with_retry(call)) == "ok"
+    assert sleeps == [negotiation_engine.MAX_RETRY_DELAY]
+
+
+def test_with_retry_stops_at_the_deadline(sleeps):
+    async def call():
+        raise rate_limited("10s")
+
+    with pytest.raises(negotiation_engine.RetryDeadlineExceeded):
+        asyncio.run(negotiation_engine.with_retry(call, deadline=time.time() + 5))
+    assert sleeps == []
+
+
+def test_with_retry_does_not_retry_other_errors(sleeps):
+    async def call():
+        raise genai_errors.APIError(400, {"error": {"message": "bad request"}})
+
+    with pytest.raises(genai_errors.APIError):
+        asyncio.run(negotiation_engine.with_retry(call))
+    assert sleeps == []
+
+
+def first_turns(chat1, chat2, turns, duration_seconds=60, mode="strict"):
+    """Streams a negotiation into a transcript, stopping once the first turns are complete."""
+    async def collect():
+        transcript = negotiation_engine.new_transcript()
+        stream = negotiation_engine.stream_negotiation(
+            chat1, chat2, "A", "B", "p1", "p2", duration_seconds, mode=mode
+        )
+        async for row in stream:
+            if row.get("turn", 0) >= turns:
+                break
+            negotiation_engine.add_to_transcript(transcript, row)
+        await stream.aclose()
+        return transcript
+
+    return asyncio.run(collect())
+
+
+def test_rate_limited_turn_is_recorded_and_attempted_again(sleeps):
+    chat1 = FakeChat("A", replies=["A1"])
+    # Rate limited on every attempt of the first try at the turn
+    chat2 = FakeChat("B", replies=[rate_limited()] * 4 + ["B1"])
+    transcript = first_turns(chat1, chat2, turns=2)
+
+    rows = negotiation_engine.transcript_rows(transcript)
+    assert rows == [
+        {"turn": 0, "speaker": "A", "message": "A1"},
+        {"error": rows[1]["error"]},
+        {"turn": 1, "speaker": "B", "message": "B1"},
+    ]
+    assert "429" in rows[1]["error"]
+    assert len(sleeps) == 3
+
+
+class AlwaysRateLimitedChat(FakeChat):
+    def __init__(self, name, retry_delay=None):
+        super().__init__(name)
+        self.retry_delay = retry_delay
+
+    def reply(self):
+        raise rate_limited(self.retry_delay)
+
+
+@pytest.mark.parametrize("mode", ["strict", "parallel"])
+@pytest.mark.parametrize("retry_delay, duration_seconds", [("20s", 3), (None, 1)])
+def test_persistent_rate_limit_ends_the_negotiation(mode, retry_delay, duration_seconds):
+    chat1 = FakeChat("A")
+    chat2 = AlwaysRateLimitedChat("B", retry_delay)
+    transcript = run(chat1, chat2, duration_seconds=duration_seconds, mode=mode)
+
+    # Waiting to retry would outlast the budget, so B is not called again
+    assert len(chat2.received) == 1
+    assert len(transcript["error"]) == 1
+    assert "no time left to retry" in transcript["error"][0]
+
+
+def test_empty_replies_become_empty_strings():
+    chat1 = FakeChat("A")
+    chat2 = FakeChat("B", replies=[None, None])
+    transcript = run(chat1, chat2, duration_seconds=0.05, mode="parallel")
+
+    assert all(isinstance(message, str) for message in transcript["message"])
+    assert transcript["message"][1] == ""
+    # The blocked opening is passed on as an empty message, not None
+    assert chat1.received[1] == ""
+
+
+def test_parallel_mode_carries_over_messages_a_failed_party_missed(sleeps):
+    chat1 = FakeChat("A", replies=["A1", "A2", "A3"])
+    chat2 = FakeChat("B", replies=["B1"] + [rate_limited()] * 4 + ["B2"])
+    transcript = first_turns(chat1, chat2, turns=5, mode="parallel")
+
+    rows = negotiation_engine.transcript_rows(transcript)
+    assert [row.get("message", "error") for row in rows[:4]] == ["A1", "B1", "A2", "error"]
+    # B never answered A1, so its next message holds both A1 and A2
+    assert chat2.received[:6] == ["p2"] + ["A1"] * 4 + ["A1\n\nA2"]
+    # A waits for B instead of answering B1 a second time
+    assert chat1.received[:3] == ["p1", "B1", "B2"]
+
+
+def test_parallel_mode_keeps_the_opening_that_succeeded(sleeps):
+    chat1 = FakeChat("A", replies=["A1", "A2"])
+    chat2 = FakeChat("B", replies=[rate_limited()] * 4 + ["B1"])
+    transcript = first_turns(chat1, chat2, turns=2, mode="parallel")
+
+    rows = negotiation_engine.transcript_rows(transcript)
+    assert [row.get("message", "error") for row in rows] == ["A1", "error", "B1"]
+    # B's opening prompt is carried into the next round along with A's opening
+    assert chat2.received[-1] == "p2\n\nA1"
+
+
+def test_parallel_mode_records_the_other_reply_before_a_fatal_error():
+    chat1 = FakeChat("A")
+    chat2 = FakeChat("B", replies=[genai_errors.APIError(400, {"error": {"message": "bad request"}})])
+    transcript = run(chat1, chat2, duration_seconds=60, mode="parallel")
+
+    assert transcript["message"] == ["A1"]
+    assert "bad request" in transcript["error"][0]